@@ -2,42 +2,31 @@ from __future__ import annotations
 
 import abc
 import asyncio
+import inspect
 import json
+import math
 import os
-import sys
-import threading
-import time
 import webbrowser
 from enum import Enum
 from typing import TYPE_CHECKING
 
 import requests
 from prompt_toolkit.application import get_app
-from prompt_toolkit.formatted_text import HTML
+from prompt_toolkit.formatted_text import HTML, merge_formatted_text
 from prompt_toolkit.key_binding import KeyBindings, merge_key_bindings
 from prompt_toolkit.key_binding.bindings.focus import focus_next, focus_previous
 from prompt_toolkit.layout.containers import HSplit, VSplit, Window, WindowAlign
 from prompt_toolkit.layout.controls import FormattedTextControl
 from prompt_toolkit.widgets import Button, Box, Label, Frame
-from sentry_sdk import configure_scope
 
-from riitag import oauth2, user, watcher, presence
+from riitag import oauth2, user, watcher, presence, telemetry, instrumentation
+from riitag.exceptions import RiitagNotFoundError
 from riitag.util import get_cache
 
 
-# Get resource when frozen with PyInstaller
-def resource_path(relative_path):
-    if hasattr(sys, '_MEIPASS'):
-        return os.path.join(sys._MEIPASS, relative_path)
-    return os.path.join(os.path.abspath("."), relative_path)
-
-
 if TYPE_CHECKING:
     from start import RiiTagApplication
 
-with open(resource_path('banner.txt'), 'r+') as banner:
-    BANNER = banner.read()
-
 
 class SettingsModifyMode(Enum):
     INCREASE = 1
@@ -83,53 +72,43 @@ class Menu(metaclass=abc.ABCMeta):
     def __init__(self, application: RiiTagApplication = None):
         self.app = application
 
-        self._run = True
-        self._tasks = []
-        self._task_thread = threading.Thread(
-            target=self._task_manager,
-            daemon=True
-        )
+        self._tasks: set[asyncio.Task] = set()
 
-    def _task_manager(self):
-        while self._run:
-            to_delete = []
+    def update(self):
+        self.app.invalidate()
 
-            curr_time = int(time.time())
-            for task in self._tasks:
-                if curr_time >= task[0]:
-                    task[1]()
-                    to_delete.append(task)
+    def run_task(self, coroutine):
+        """Runs a coroutine on the application's event loop, it is cancelled when the menu exits."""
+        task = self.app.create_background_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-            if to_delete:
-                self.update()
+        return task
 
-            for task in to_delete:
-                self._tasks.remove(task)
+    def exec_after(self, seconds, callback):
+        async def run_later():
+            await asyncio.sleep(seconds)
 
-            time.sleep(0.5)
+            result = callback()
+            if inspect.isawaitable(result):
+                await result
 
-    def update(self):
-        self.app.invalidate()
+            self.update()
 
-    def exec_after(self, seconds, callback):
-        exec_at = int(time.time()) + seconds
-        self._tasks.append((exec_at, callback))
+        return self.run_task(run_later())
 
     def on_start(self):
-        self._task_thread.start()
+        pass
 
     def on_exit(self):
-        self._run = False
-
-        # self._task_thread will just die off eventually... no reason to join()
-        self._task_thread = None
+        for task in list(self._tasks):
+            task.cancel()
 
     def quit_app(self):
         self.on_exit()
 
         if self.app.riitag_watcher:
             self.app.riitag_watcher.stop()
-            self.app.riitag_watcher.join(timeout=5)
 
         self.app.exit()
 
@@ -161,27 +140,25 @@ class SplashScreen(Menu):
     name = 'Splash Screen'
     is_framed = False
 
+    CONNECT_MIN_DELAY = 2
+    CONNECT_MAX_DELAY = 30
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self._connect_attempt = 0
-        self._is_connecting = False
+        self._connect_task: asyncio.Task | None = None
+        self._retry_now = asyncio.Event()
 
         self.status_str = 'Loading...'
 
     def get_layout(self):
-        return HSplit([
-            Window(FormattedTextControl(BANNER), align=WindowAlign.CENTER),
-            Window(FormattedTextControl(
-                f'{self.app.version_string}\nCreated by Mike Almeloo\n\n\n{self.status_str}'),
-                align=WindowAlign.CENTER
-            )
-        ])
+        return self.app.get_splash_layout(self.status_str)
 
     def on_start(self):
         super().on_start()
 
-        self.exec_after(5, self._new_connect)
+        self.run_task(self._start())
 
     def get_kb(self):
         kb = KeyBindings()
@@ -189,7 +166,7 @@ class SplashScreen(Menu):
         # time traveller!?!?
         @kb.add('enter')
         def skip_loading(_):
-            self._new_connect()
+            self._retry_now.set()
 
         return kb
 
@@ -197,71 +174,122 @@ class SplashScreen(Menu):
     def is_token_cached(self):
         return os.path.isfile(get_cache('token.json'))
 
-    def _refresh_token(self, token):
+    async def _refresh_token(self, token_manager):
         try:
-            token.refresh()
-            token.save(get_cache('token.json'))
+            await asyncio.to_thread(token_manager.refresh, True)
 
-            self.app.token = token
-            self.app.user = token.get_user()
+            self.app.token = token_manager.token
+            self.app.user = await asyncio.to_thread(token_manager.get_user)
         except requests.HTTPError:  # token revoked, modified?
-            self.app.set_menu(SetupMenu)
+            return SetupMenu
 
-            return
+        self.app.token_manager = token_manager
+        token_manager.start()
 
-        self.app.set_menu(MainMenu)
+        return MainMenu
 
-    def _new_connect(self):
-        if self._is_connecting:
-            return
+    async def _start(self):
+        timer = self.app.startup_timer
+
+        # none of these depend on each other, so don't wait for Discord before doing the rest
+        self._connect_task = self.run_task(timer.measure('ipc', self._connect_presence()))
+        titles_task = self.run_task(timer.measure('titles', asyncio.to_thread(self._load_titles)))
 
-        self._is_connecting = True
-        self._connect_presence()
+        next_menu = await timer.measure('login', self._login())
+        if next_menu is MainMenu:
+            await timer.measure('riitag', self._prefetch_riitag(titles_task))
 
-    def _connect_presence(self):
-        new_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(new_loop)
+        await self._connect_task
 
-        self._connect_attempt += 1
+        timer.mark('menu')
+        self.app.set_menu(next_menu)
+
+    # noinspection PyMethodMayBeStatic
+    def _load_titles(self):
+        # only what's on disk, the console that's actually played gets updated when it's first resolved
+        for console in presence.resolver.TITLE_URLS:
+            presence.resolver.load(console)
+
+    async def _prefetch_riitag(self, titles_task):
+        # the watcher picks up the fetched tag from the user, see MainMenu._start_thread
+        try:
+            riitag = await self.app.user.fetch_riitag_async()
+        except RiitagNotFoundError:
+            return  # the watcher will let the user know
+
+        if riitag:
+            # resolve the game's name and cover while we're waiting for Discord anyway
+            await titles_task
+            await presence.format_presence(riitag)
+
+    async def _connect_presence(self):
+        loop = asyncio.get_running_loop()
+
+        delay = self.CONNECT_MIN_DELAY
+        while True:
+            self._connect_attempt += 1
+
+            if await self.app.rpc_handler.connect():
+                break
+
+            # wait before the next attempt, unless the user asks to retry right away
+            retry_at = loop.time() + delay
+            while (remaining := retry_at - loop.time()) > 0:
+                self.status_str = f'Trying to connect... ({self._connect_attempt})\n' \
+                                  f'Please make sure your Discord client is running.\n\n' \
+                                  f'Retrying in {math.ceil(remaining)}s, press enter to retry now.'
+                self.update()
 
-        self.app.rpc_handler.connect()
+                try:
+                    await asyncio.wait_for(self._retry_now.wait(), min(remaining, 1))
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            self._retry_now.clear()
 
-        if not self.app.rpc_handler.is_connected:
             self.status_str = f'Trying to connect... ({self._connect_attempt})\n' \
                               f'Please make sure your Discord client is running.'
             self.update()
 
-            time.sleep(4)
-            self._connect_presence()
-        else:
-            self._login()
+            delay = min(delay * 2, self.CONNECT_MAX_DELAY)
 
-    def _login(self):
+    async def _login(self):
+        """Loads the cached login, returns the menu to continue to."""
         if self.is_token_cached:
             with open(get_cache('token.json'), 'r') as file:
                 token_data = json.load(file)
             try:
                 token = oauth2.OAuth2Token(self.app.oauth_client, **token_data)
-                if token.needs_refresh:
+                token_manager = oauth2.OAuth2TokenManager(token, get_cache('token.json'), get_cache('user.json'))
+                if token.needs_refresh:  # expired, we can't do anything without a new one
                     self.status_str = 'Refreshing Discord connection...'
                     self.update()
 
-                    self.exec_after(0.5, lambda: self._refresh_token(token))
+                    return await self._refresh_token(token_manager)
 
                 else:
                     self.app.token = token
-                    try:
-                        self.app.user = token.get_user()
-                    except requests.HTTPError:  # generic error
-                        self.app.set_menu(SetupMenu)
-
-                        return
 
-                    self.app.set_menu(MainMenu)
+                    cached_user, is_fresh = token_manager.get_cached_user()
+                    if cached_user:  # no need to wait for Discord, check in the background if it's outdated
+                        self.app.user = cached_user
+                        if not is_fresh:
+                            self.app.create_background_task(token_manager.revalidate_user(cached_user))
+                    else:
+                        try:
+                            self.app.user = await asyncio.to_thread(token_manager.get_user)
+                        except requests.HTTPError:  # generic error
+                            return SetupMenu
+
+                    # refreshes ahead of expiry happen in the background from now on
+                    self.app.token_manager = token_manager
+                    token_manager.start()
+
+                    return MainMenu
             except KeyError:  # invalid token in cache?
-                self.app.set_menu(SetupMenu)
+                return SetupMenu
         else:
-            self.app.set_menu(SetupMenu)
+            return SetupMenu
 
 
 # noinspection PyMethodMayBeStatic
@@ -269,6 +297,8 @@ class SetupMenu(Menu):
     name = 'Setup'
     is_framed = True
 
+    LOGIN_TIMEOUT = 10 * 60
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -290,9 +320,15 @@ class SetupMenu(Menu):
                 '<b>Press enter to log in again.</b>',
             )), align=WindowAlign.CENTER, wrap_lines=True)
 
-        self.waiting_layout = HSplit([
+        self.waiting_layout = self._create_waiting_layout()
+        self._token_task: asyncio.Task | None = None
+
+    # noinspection PyMethodMayBeStatic
+    def _create_waiting_layout(self):
+        return HSplit([
             Window(FormattedTextControl(HTML(
-                '\n\n\nWe\'ll try to automagically open up your browser. Fingers crossed...'
+                '\n\n\nWe\'ll try to automagically open up your browser. Fingers crossed...\n'
+                'Press escape to cancel.'
             )), align=WindowAlign.CENTER, wrap_lines=True)
         ])
 
@@ -313,11 +349,24 @@ class SetupMenu(Menu):
                 self.state = 'waiting'
                 self.update()
 
-                self.exec_after(2, self._get_token)
+                self._token_task = self.exec_after(2, self._get_token)
+
+        @kb.add('escape')
+        def cancel_login(_):
+            if self.state == 'waiting' and self._token_task:
+                self._cancel_login()
 
         return kb
 
-    def _get_token(self):
+    def _cancel_login(self):
+        self._token_task.cancel()
+        self._token_task = None
+
+        self.state = 'setup_start'
+        self.waiting_layout = self._create_waiting_layout()
+        self.update()
+
+    async def _get_token(self):
         auth_url = self.app.oauth_client.auth_url
         try:
             webbrowser.open(auth_url)
@@ -335,8 +384,13 @@ class SetupMenu(Menu):
             )
 
         self.update()
-        code = self.app.oauth_client.wait_for_code()
+        try:
+            code = await self.app.oauth_client.wait_for_code_async(timeout=self.LOGIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._cancel_login()
+            return
 
+        self._token_task = None  # too late to cancel now
         self.waiting_layout.children = [
             Window(FormattedTextControl(HTML(
                 '\n\n\n\n\nFinishing the last bits...'
@@ -344,13 +398,15 @@ class SetupMenu(Menu):
         ]
         self.update()
 
-        token = self.app.oauth_client.get_token(code)
+        token = await asyncio.to_thread(self.app.oauth_client.get_token, code)
         token.save(get_cache('token.json'))
         self.app.token = token
+        self.app.token_manager = oauth2.OAuth2TokenManager(token, get_cache('token.json'), get_cache('user.json'))
+        self.app.token_manager.start()
 
-        self.app.user = token.get_user()
+        self.app.user = await asyncio.to_thread(self.app.token_manager.get_user)
 
-        time.sleep(2)
+        await asyncio.sleep(2)
         self.waiting_layout.children = [
             Window(
                 FormattedTextControl(
@@ -364,7 +420,7 @@ class SetupMenu(Menu):
         ]
         self.update()
 
-        time.sleep(2)
+        await asyncio.sleep(2)
         self.app.set_menu(MainMenu)
 
 
@@ -379,11 +435,11 @@ class MainMenu(Menu):
         self.riitag_info = user.RiitagInfo()  # placeholder
 
         if discord_user := self.app.user:
-            with configure_scope() as scope:
-                scope.set_tag('discord.user', f'{discord_user.username}#{discord_user.discriminator}')
-                scope.set_tag('discord.id', discord_user.id)
+            telemetry.set_tag('discord.user', f'{discord_user.username}#{discord_user.discriminator}')
+            telemetry.set_tag('discord.id', discord_user.id)
 
         self.menu_settings_button = Button('Settings', handler=lambda: self._set_state('Settings'))
+        self.menu_stats_button = Button('Stats', handler=lambda: self._set_state('Stats'))
         self.menu_view_button = Button('View Tag', handler=self.view_riitag)
         self.menu_exit_button = Button('Exit', handler=self.quit_app)
         self.menu_logout_button = Button('Logout', handler=self._logout)
@@ -401,11 +457,16 @@ class MainMenu(Menu):
             limits=(30, 60)
         )
 
+        self.stats_back_button = Button('Back...', width=12, handler=lambda: self._set_state('Menu'))
+        self._stats_task: asyncio.Task | None = None
+        self.stats_export_button = Button('Export...', width=12, handler=self._export_stats)
+
         self.right_panel_state = 'Menu'
         self.menu_layout = Frame(
             Box(
                 HSplit([
                     self.menu_settings_button,
+                    self.menu_stats_button,
                     Label(''),
                     self.menu_view_button,
                     self.menu_exit_button,
@@ -433,6 +494,18 @@ class MainMenu(Menu):
             ),
             title='Settings'
         )
+        self.stats_layout = Frame(
+            Box(
+                HSplit([
+                    Window(FormattedTextControl(self._get_stats_text), wrap_lines=False),
+                    Label(''),
+                    VSplit([self.stats_back_button, self.stats_export_button], align=WindowAlign.CENTER)
+                ]),
+                padding_left=3,
+                padding_top=1
+            ),
+            title='Stats'
+        )
 
     def on_start(self):
         super().on_start()
@@ -440,6 +513,13 @@ class MainMenu(Menu):
         self.app.layout.focus(self.menu_settings_button)
         self._start_thread()
 
+        presence.resolver.add_update_listener(self._on_titles_updated)
+
+    def on_exit(self):
+        super().on_exit()
+
+        presence.resolver.remove_update_listener(self._on_titles_updated)
+
     def get_layout(self):
         game_labels = []
         for game in self.riitag_info.games:
@@ -461,6 +541,8 @@ class MainMenu(Menu):
             right_panel_layout = self.menu_layout
         elif self.right_panel_state == 'Settings':
             right_panel_layout = self.settings_layout
+        elif self.right_panel_state == 'Stats':
+            right_panel_layout = self.stats_layout
 
         return HSplit([
             Box(
@@ -514,7 +596,11 @@ class MainMenu(Menu):
 
     def _logout_callback(self, confirm):
         if confirm:
+            if self.app.token_manager:  # don't let a refresh bring the token back
+                self.app.token_manager.stop()
             os.remove(get_cache('token.json'))
+            if os.path.isfile(get_cache('user.json')):
+                os.remove(get_cache('user.json'))
             self.app.exit()
 
     def _logout(self):
@@ -552,6 +638,9 @@ class MainMenu(Menu):
 
         self.app.preferences.save(get_cache('prefs.json'))
 
+        if is_modified and self.app.riitag_watcher:
+            self.app.riitag_watcher.preferences_changed()
+
         return is_modified
 
     def _reset_preferences(self):
@@ -563,6 +652,9 @@ class MainMenu(Menu):
         self.settings_check_interval_button.value = self.app.preferences.check_interval
         self.settings_check_interval_button.update()
 
+        if self.app.riitag_watcher:
+            self.app.riitag_watcher.preferences_changed()
+
     def _set_state(self, state):
         self.right_panel_state = state
 
@@ -572,21 +664,69 @@ class MainMenu(Menu):
             self.app.layout.focus(self.menu_settings_button)
         elif state == 'Settings':
             self.app.layout.focus(self.settings_back_button)
+        elif state == 'Stats':
+            self.app.layout.focus(self.stats_back_button)
+            if not self._stats_task or self._stats_task.done():  # still running if we just left
+                self._stats_task = self.run_task(self._refresh_stats())
+
+    async def _refresh_stats(self):
+        while self.right_panel_state == 'Stats':
+            self.update()
+            await asyncio.sleep(1)
+
+    def _get_stats_text(self):
+        lines = []
+        for name, metric in instrumentation.registry.to_dict().items():
+            if metric['type'] == 'histogram':
+                if not metric['count']:
+                    continue
+
+                lines.append(HTML('<b>{}</b>\n  {}x, avg {:.0f}ms, p95 {:.0f}ms, max {:.0f}ms\n').format(
+                    name.removesuffix('_seconds'), metric['count'],
+                    metric['mean'] * 1000, metric['p95'] * 1000, metric['max'] * 1000
+                ))
+            elif metric['value'] or not name.endswith('_errors_total'):  # no news is good news
+                lines.append(HTML('<b>{}</b>: {}\n').format(name, metric['value']))
+
+        if first_presence := self.app.startup_timer.marks.get('first_presence'):
+            lines.append(HTML('<b>startup_first_presence</b>: {:.2f}s\n').format(first_presence))
 
-    def _update_riitag(self, riitag: user.RiitagInfo):
+        return merge_formatted_text(lines)
+
+    def _export_stats(self):
+        json_fn = get_cache('metrics.json')
+        prometheus_fn = get_cache('metrics.prom')
+        instrumentation.registry.export(json_fn, 'json')
+        instrumentation.registry.export(prometheus_fn, 'prometheus')
+
+        self.app.show_message(
+            'Stats exported',
+            'The stats have been saved to:\n\n' + json_fn + '\n' + prometheus_fn
+        )
+
+    async def _update_riitag(self, riitag: user.RiitagInfo):
         if not riitag:
             return
 
         self.riitag_info = riitag
 
         if not riitag.outdated:
-            options = presence.format_presence(self.riitag_info)
-            self.app.rpc_handler.set_presence(**options)
+            options = await presence.format_presence(self.riitag_info)
+            await self.app.presence_dispatcher.set_presence(**options)
+
+            if 'first_presence' not in self.app.startup_timer.marks:
+                self.app.startup_timer.mark('first_presence')
+                self.app.startup_timer.save(get_cache('startup.json'))
         else:
-            self.app.rpc_handler.clear()
+            await self.app.presence_dispatcher.clear()
 
         self.update()
 
+    def _on_titles_updated(self):
+        # names might have been 'Unknown' before, resend the presence
+        if self.app.riitag_watcher:
+            self.app.riitag_watcher.request_update()
+
     def view_riitag(self):
         client_id = self.app.user.id
         tag_url = f"https://tag.rc24.xyz/{client_id}"
@@ -603,6 +743,7 @@ class MainMenu(Menu):
             preferences=self.app.preferences,
             user=self.app.user,
             update_callback=self._update_riitag,
-            message_callback=None
+            message_callback=None,
+            riitag=self.app.user.riitag  # fetched during startup
         )
         self.app.riitag_watcher.start()
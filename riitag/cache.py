@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+
+from .util import atomic_write
+
+
+class PersistentCache:
+    def __init__(self, fn, max_entries=512):
+        """Small key/value cache with per-entry TTLs, persisted as JSON.
+
+        :param fn: the file to persist the cache to.
+        :param max_entries: entries above this limit are evicted, oldest first.
+        """
+        self._fn = fn
+        self._max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict] = self._load()
+
+    def _load(self):
+        try:
+            with open(self._fn) as file:
+                data = json.load(file)
+        except (OSError, ValueError):  # missing or corrupt, start over
+            return {}
+
+        if not isinstance(data, dict):
+            return {}
+
+        return data
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._entries)
+
+        try:
+            atomic_write(self._fn, data)
+        except OSError:
+            pass  # not fatal, we'll just probe again next time
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return default
+
+            if time.time() >= entry['expires']:
+                del self._entries[key]
+                return default
+
+            return entry['value']
+
+    def set(self, key: str, value, ttl: float):
+        with self._lock:
+            # re-insert so the dict order stays oldest -> newest
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                'value': value,
+                'expires': time.time() + ttl
+            }
+
+            self._evict()
+
+        self.save()
+
+    def _evict(self):
+        if len(self._entries) <= self._max_entries:
+            return
+
+        now = time.time()
+        for key in [k for k, entry in self._entries.items() if now >= entry['expires']]:
+            del self._entries[key]
+
+        while len(self._entries) > self._max_entries:
+            del self._entries[next(iter(self._entries))]
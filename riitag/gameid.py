@@ -0,0 +1,49 @@
+# Helpers to decode information from Wii / Wii U game IDs.
+#
+# A game ID looks like RMCP01: the first character is the system / disc type,
+# the fourth character the region and the last two the publisher.
+
+# region character -> GameTDB art regions, most likely first
+COVER_REGIONS = {
+    'E': ('US', 'EN'),
+    'J': ('JA',),
+    'K': ('KO', 'JA'),
+    'W': ('ZHTW', 'JA'),
+
+    # PAL, with their language specific art if GameTDB has it
+    'P': ('EN',),
+    'X': ('EN',),
+    'Y': ('EN',),
+    'D': ('DE', 'EN'),
+    'F': ('FR', 'EN'),
+    'S': ('ES', 'EN'),
+    'I': ('IT', 'EN'),
+    'H': ('NL', 'EN'),
+    'U': ('AU', 'EN'),
+}
+DEFAULT_COVER_REGIONS = ('EN', 'US', 'JA')
+
+WIIU_SYSTEM_CODES = ('A', 'B')
+
+
+def get_region_char(game_id: str):
+    if not game_id or len(game_id) < 4:
+        return None
+
+    return game_id[3].upper()
+
+
+def get_cover_regions(game_id: str, default=DEFAULT_COVER_REGIONS):
+    """The GameTDB art regions that could have a cover for this game, most likely first.
+
+    Falls back to `default` if the region can't be determined.
+    """
+    return COVER_REGIONS.get(get_region_char(game_id), default)
+
+
+def get_console(game_id: str):
+    """Best guess of the console a game ID belongs to."""
+    if game_id and game_id[0].upper() in WIIU_SYSTEM_CODES:
+        return 'wiiu'
+
+    return 'wii'
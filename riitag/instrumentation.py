@@ -0,0 +1,226 @@
+"""Lightweight metrics for the hot paths: counters, histograms and timers.
+
+Everything is kept in memory in the module-level `registry`, which can be exported as JSON or in the
+Prometheus text format.
+"""
+import functools
+import inspect
+import json
+import math
+import threading
+import time
+
+from .util import atomic_write
+
+# in seconds, from a cached lookup up to a request that ran into its timeout
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def to_dict(self):
+        return {'value': self.value}
+
+    def to_prometheus(self):
+        return [f'{self.name} {self.value}']
+
+
+class CounterFunc:
+    kind = 'counter'
+
+    def __init__(self, name, description, func):
+        """A counter whose total is kept elsewhere, read when exporting.
+
+        :param func: returns the current total
+        """
+        self.name = name
+        self.description = description
+        self._func = func
+
+    @property
+    def value(self):
+        return self._func()
+
+    def to_dict(self):
+        return {'value': self.value}
+
+    def to_prometheus(self):
+        return [f'{self.name} {self.value}']
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+
+        self._lock = threading.Lock()
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """Estimates a quantile from the buckets, like Prometheus' histogram_quantile."""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), self.bucket_counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if bound == math.inf:
+                    return self.max
+                return min(lower + (bound - lower) * (rank - cumulative) / bucket_count, self.max)
+            cumulative += bucket_count
+            lower = bound
+
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.mean,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': self.max
+        }
+
+    def to_prometheus(self):
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), self.bucket_counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == math.inf else repr(float(bound))
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics = {}
+
+    def _get_or_create(self, cls, name, *args):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'{name} is already registered as a {metric.kind}')
+
+            return metric
+
+    def counter(self, name, description) -> Counter:
+        return self._get_or_create(Counter, name, description)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, description, buckets)
+
+    def counter_func(self, name, description, func) -> CounterFunc:
+        """Registers a counter read from `func`, replacing an earlier one with the same name."""
+        with self._lock:
+            counter = self.metrics[name] = CounterFunc(name, description, func)
+
+            return counter
+
+    def _snapshot(self):
+        with self._lock:
+            return list(self.metrics.items())
+
+    def to_dict(self):
+        return {name: {'type': metric.kind, **metric.to_dict()} for name, metric in self._snapshot()}
+
+    def to_prometheus(self):
+        lines = []
+        for name, metric in self._snapshot():
+            lines.append(f'# HELP {name} {metric.description}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.to_prometheus())
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, fn, fmt='json'):
+        """Writes all metrics to `fn`.
+
+        :param fmt: 'json' or 'prometheus'
+        """
+        if fmt == 'json':
+            data = json.dumps(self.to_dict(), indent=4)
+        elif fmt == 'prometheus':
+            data = self.to_prometheus()
+        else:
+            raise ValueError(f'Unknown format: {fmt}')
+
+        atomic_write(fn, data)
+
+
+registry = Registry()
+
+
+def timed(name, description):
+    """Decorator that records how long each call takes in a histogram, works on coroutine functions too.
+
+    Calls that raise are counted in `<name>_errors_total` as well.
+    """
+    histogram = registry.histogram(f'{name}_seconds', description)
+    errors = registry.counter(f'{name}_errors_total', f'Failed calls, see {name}_seconds')
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
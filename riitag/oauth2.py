@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import threading
 import time
@@ -8,8 +9,11 @@ from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from typing import Any
 
 import requests
+from prompt_toolkit.application import get_app
 
+from .session import get_session
 from .user import User
+from .util import atomic_write
 
 API_ENDPOINT = 'https://discord.com/api'
 AUTHORIZE_ENDPOINT = 'https://discord.com/api/oauth2/authorize'
@@ -17,6 +21,8 @@ TOKEN_ENDPOINT = 'https://discord.com/api/oauth2/token'
 
 
 class OAuth2Token:
+    REFRESH_MARGIN = 24 * 60 * 60  # refresh a day before expiring, Discord tokens last a week
+
     def __init__(self, client: OAuth2Client, **kwargs):
         self._client = client
 
@@ -36,6 +42,16 @@ class OAuth2Token:
         curr_time = time.time()
         return curr_time - self.last_refresh > self.expires_in
 
+    @property
+    def refresh_at(self):
+        """When the token should be refreshed, a safe margin before it expires."""
+        margin = min(self.REFRESH_MARGIN, self.expires_in / 2)
+        return self.last_refresh + self.expires_in - margin
+
+    @property
+    def should_refresh(self):
+        return time.time() >= self.refresh_at
+
     def save(self, fn):
         data = {
             'access_token': self.access_token,
@@ -46,8 +62,7 @@ class OAuth2Token:
             'last_refresh': self.last_refresh
         }
 
-        with open(fn, 'w+') as file:
-            json.dump(data, file, indent=4)
+        atomic_write(fn, json.dumps(data, indent=4))
 
     def refresh(self):
         payload = {
@@ -61,7 +76,7 @@ class OAuth2Token:
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        r = requests.post(TOKEN_ENDPOINT, data=payload, headers=headers)
+        r = get_session().post(TOKEN_ENDPOINT, data=payload, headers=headers)
         r.raise_for_status()
 
         token_data = r.json()
@@ -76,19 +91,123 @@ class OAuth2Token:
         return True
 
     def get_user(self) -> User:
-        if self.needs_refresh:
-            self.refresh()
-
         headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {self.access_token}'
         }
-        r = requests.get(f'{API_ENDPOINT}/users/@me', headers=headers)
+        r = get_session().get(f'{API_ENDPOINT}/users/@me', headers=headers)
         r.raise_for_status()
 
         return User(**r.json())
 
 
+class OAuth2TokenManager:
+    RETRY_DELAY = 5 * 60
+    USER_CACHE_TTL = 24 * 60 * 60
+
+    def __init__(self, token: OAuth2Token, fn, user_fn=None):
+        """Keeps a token fresh, and saved to `fn`.
+
+        Refreshes happen ahead of time in the background, see OAuth2Token.refresh_at.
+
+        :param user_fn: where to cache the user's profile, so it doesn't have to be fetched on every start
+        """
+        self.token = token
+        self._fn = fn
+        self._user_fn = user_fn
+
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    def refresh(self, force=False):
+        """Refreshes the token if it is due, returns whether it was refreshed.
+
+        Concurrent callers share a single refresh request.
+        """
+        last_refresh = self.token.last_refresh
+        with self._lock:
+            if self.token.last_refresh != last_refresh:  # refreshed while we were waiting
+                return True
+            if not force and not self.token.should_refresh:
+                return False
+
+            self.token.refresh()
+            self.token.save(self._fn)
+
+            return True
+
+    def get_user(self) -> User:
+        if self.token.needs_refresh:  # can't be used anymore, we'll have to wait
+            self.refresh()
+
+        user = self.token.get_user()
+        if self._user_fn:
+            data = {'fetched_at': time.time(), 'user': user.to_dict()}
+            atomic_write(self._user_fn, json.dumps(data, indent=4))
+
+        return user
+
+    def get_cached_user(self) -> tuple[User | None, bool]:
+        """Returns the cached profile and whether it is still fresh, or (None, False) if there is none."""
+        if not self._user_fn:
+            return None, False
+
+        try:
+            with open(self._user_fn, 'r') as file:
+                data = json.load(file)
+
+            user = User(**data['user'])
+            fetched_at = data['fetched_at']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, False
+
+        return user, time.time() - fetched_at < self.USER_CACHE_TTL
+
+    async def revalidate_user(self, user: User):
+        """Fetches the profile again, and updates `user` with it."""
+        try:
+            new_user = await asyncio.to_thread(self.get_user)
+        except requests.RequestException:
+            return  # keep using the cached one, we'll try again on the next start
+
+        user.update_profile(new_user)
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+
+        self._task = get_app().create_background_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(max(self.token.refresh_at - time.time(), 0))
+
+            try:
+                await asyncio.to_thread(self.refresh)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code in (400, 401):
+                    return  # revoked, we'll ask to log in again on the next start
+
+                # rate limited or a server issue, worth another try
+                await asyncio.sleep(self._get_retry_delay(e.response))
+            except requests.RequestException:
+                await asyncio.sleep(self.RETRY_DELAY)
+
+    def _get_retry_delay(self, response):
+        if response is not None and response.status_code == 429:
+            try:
+                return max(float(response.headers.get('Retry-After', '')), 0)
+            except ValueError:
+                pass
+
+        return self.RETRY_DELAY
+
+
 class RequestHandler(BaseHTTPRequestHandler):
     # noinspection PyPep8Naming
     def do_GET(self):
@@ -102,7 +221,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         if not code or len(code) != 1:
             self.handle_400()
             return
-        self.server.code = code[0]
+        self.server.set_code(code[0])
 
         self.send_response(200)
         self.send_header("Content-type", "text/plain")
@@ -135,8 +254,38 @@ class OAuth2HTTPServer(ThreadingHTTPServer):
     def __init__(self, *args, **kwargs):
         self.code = None
 
+        self._waiters: list[asyncio.Future] = []
+        self._waiters_lock = threading.Lock()
+
         super().__init__(*args, **kwargs)
 
+    def set_code(self, code):
+        """Hands the code over to whoever is waiting for it. Called from the request handler threads."""
+        self.code = code
+
+        with self._waiters_lock:
+            waiters, self._waiters = self._waiters, []
+        for future in waiters:
+            future.get_loop().call_soon_threadsafe(self._resolve, future, code)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, code):
+        if not future.done():  # could've been cancelled in the meantime
+            future.set_result(code)
+
+    def add_waiter(self, future: asyncio.Future):
+        with self._waiters_lock:
+            if self.code is None:
+                self._waiters.append(future)
+                return
+
+        future.set_result(self.code)
+
+    def remove_waiter(self, future: asyncio.Future):
+        with self._waiters_lock:
+            if future in self._waiters:
+                self._waiters.remove(future)
+
 
 class OAuth2Client:
     def __init__(self, config: dict):
@@ -166,13 +315,21 @@ class OAuth2Client:
 
         return f'{AUTHORIZE_ENDPOINT}?{query_str}'
 
-    def wait_for_code(self):
+    async def wait_for_code_async(self, timeout=None):
+        """Waits until the user finished logging in through the browser. Cancel the task to stop waiting.
+
+        :raises TimeoutError: if no code was received within `timeout` seconds.
+        """
         if not self._http_server:
             raise RuntimeError('Server not yet started.')
 
-        while True:
-            if code := self._http_server.code:
-                return code
+        server = self._http_server
+        future = asyncio.get_running_loop().create_future()
+        server.add_waiter(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            server.remove_waiter(future)
 
     def get_token(self, code):
         payload = {
@@ -186,7 +343,7 @@ class OAuth2Client:
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded'
         }
-        r = requests.post(TOKEN_ENDPOINT, data=payload, headers=headers)
+        r = get_session().post(TOKEN_ENDPOINT, data=payload, headers=headers)
         r.raise_for_status()
 
         return OAuth2Token(self, **r.json())
@@ -6,7 +6,10 @@ import os
 class Preferences:
     DEFAULTS = {
         'check_interval': 10,
-        'presence_timeout': 30
+        'presence_timeout': 30,
+        'min_check_interval': 5,
+        'max_check_interval': 120,
+        'telemetry_sink': None  # None uses the one from config.json
     }
 
     def __init__(self, **values):
@@ -50,3 +53,27 @@ class Preferences:
     @presence_timeout.setter
     def presence_timeout(self, value):
         self._values['presence_timeout'] = value
+
+    @property
+    def min_check_interval(self):
+        return self.get('min_check_interval')
+
+    @min_check_interval.setter
+    def min_check_interval(self, value):
+        self._values['min_check_interval'] = value
+
+    @property
+    def max_check_interval(self):
+        return self.get('max_check_interval')
+
+    @max_check_interval.setter
+    def max_check_interval(self, value):
+        self._values['max_check_interval'] = value
+
+    @property
+    def telemetry_sink(self):
+        return self.get('telemetry_sink')
+
+    @telemetry_sink.setter
+    def telemetry_sink(self, value):
+        self._values['telemetry_sink'] = value
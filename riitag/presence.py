@@ -1,31 +1,90 @@
+import asyncio
 import calendar
+import struct
+import threading
+import time
+from collections import OrderedDict
 
 import pypresence
 
-from .user import RiitagInfo, RiitagTitleResolver
+from .instrumentation import timed
+from .user import RiitagInfo, RiitagTitle, RiitagTitleResolver
+
+PRESENCE_CACHE_SIZE = 64
+
+_NOTHING = object()  # no presence sent / queued, None means a cleared presence
 
 resolver = RiitagTitleResolver()
 
+# (console, game_id, region) -> presence options, most recently used last
+_presence_cache: OrderedDict[tuple, dict] = OrderedDict()
+_presence_cache_lock = threading.Lock()
 
-def format_presence(riitag_info: RiitagInfo):
-    last_played = riitag_info.last_played
-    if not last_played:
-        return {}
 
-    start_timestamp = calendar.timegm(last_played.time.utctimetuple())
+def clear_presence_cache():
+    with _presence_cache_lock:
+        _presence_cache.clear()
 
-    title = resolver.resolve(last_played.console, last_played.game_id)
 
-    return {
+# names can change when the title database is updated
+resolver.add_update_listener(clear_presence_cache)
+
+
+def _get_cached_game_presence(console: str, game_id: str, region: str):
+    key = (console, game_id, region)
+    with _presence_cache_lock:
+        if options := _presence_cache.get(key):
+            _presence_cache.move_to_end(key)
+
+    if options:
+        resolver.update_maybe(console)  # keep the title database fresh
+
+    return options
+
+
+def _get_game_presence(console: str, game_id: str, region: str):
+    if options := _get_cached_game_presence(console, game_id, region):
+        return options
+
+    title = resolver.resolve(console, game_id)
+    options = {
         'details': f'Playing {title.name}',
         'state': f'Playing on {title.console_name}',
-        'start': start_timestamp,
 
         'large_image': title.get_cover_url(),
         'large_text': title.name,
 
         'small_image': 'logo',
         'small_text': 'tag.rc24.xyz',
+    }
+
+    # don't hold on to placeholders, they might resolve later on
+    if title.name == 'Unknown' or options['large_image'] == RiitagTitle.NOTFOUND_URL:
+        return options
+
+    with _presence_cache_lock:
+        _presence_cache[(console, game_id, region)] = options
+        while len(_presence_cache) > PRESENCE_CACHE_SIZE:
+            _presence_cache.popitem(last=False)
+
+    return options
+
+
+async def format_presence(riitag_info: RiitagInfo):
+    last_played = riitag_info.last_played
+    if not last_played:
+        return {}
+
+    start_timestamp = calendar.timegm(last_played.time.utctimetuple())
+
+    game_args = (last_played.console, last_played.game_id, last_played.region)
+    game_options = _get_cached_game_presence(*game_args)
+    if not game_options:  # cover discovery does network I/O, keep it off the event loop
+        game_options = await asyncio.to_thread(_get_game_presence, *game_args)
+
+    return {
+        **game_options,
+        'start': start_timestamp,
 
         'buttons': [
             {'label': 'View RiiTag', 'url': f'https://tag.rc24.xyz/user/{riitag_info.id}'}
@@ -34,19 +93,27 @@ def format_presence(riitag_info: RiitagInfo):
 
 
 class RPCHandler:
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 60
+    WATCHDOG_INTERVAL = 5
+
+    # errors that mean the connection to Discord is gone
+    CONNECTION_ERRORS = (pypresence.PipeClosed, ConnectionError)
+
     def __init__(self, client_id, on_error=None):
-        self._presence = pypresence.Presence(
-            client_id=client_id,
-            response_timeout=5,
-            connection_timeout=5,
-            handler=None
-        )
+        self._client_id = client_id
+        self._presence: pypresence.AioPresence | None = None  # needs a running event loop
 
         self._on_error = on_error
 
         self._is_connected = False
         self._error_count = 0
 
+        self._desired = _NOTHING  # what Discord should show, resent after reconnecting
+        self._supervisor_task: asyncio.Task | None = None
+        self._connection_lost = asyncio.Event()
+        self._send_lock = asyncio.Lock()  # pypresence can't read two responses at the same time
+
     @property
     def is_connected(self):
         return self._is_connected
@@ -57,23 +124,230 @@ class RPCHandler:
             if self._on_error:
                 self._on_error(exception, future)
 
-    def connect(self):
+    async def connect(self):
+        if not await self._connect():
+            return False
+
+        # keep the connection alive from now on
+        if not self._supervisor_task or self._supervisor_task.done():
+            self._supervisor_task = asyncio.get_running_loop().create_task(self._supervise())
+
+        return True
+
+    async def _connect(self):
+        if not self._presence:
+            self._presence = pypresence.AioPresence(
+                client_id=self._client_id,
+                response_timeout=5,
+                connection_timeout=5,
+                handler=None
+            )
+        elif self._presence.sock_writer:  # clean up the old connection
+            self._presence.sock_writer.close()
+
         try:
-            self._presence.connect()
-        except (ConnectionRefusedError, pypresence.PyPresenceException):
+            await self._presence.connect()
+        except (OSError, struct.error, pypresence.PyPresenceException):
             self._is_connected = False
             return False
         else:
             self._is_connected = True
+            self._error_count = 0
+            self._connection_lost.clear()
             return True
 
-    def clear(self):
+    def _is_connection_alive(self):
+        reader = self._presence.sock_reader
+        return reader is not None and not reader.at_eof()
+
+    def _on_connection_lost(self, exception):
+        self._is_connected = False
+        self._connection_lost.set()
+
+        self._error_handler(exception, None)
+
+    async def _supervise(self):
+        while True:
+            # Discord might go away while we're not sending anything, check every now and then
+            while self._is_connected:
+                try:
+                    await asyncio.wait_for(self._connection_lost.wait(), self.WATCHDOG_INTERVAL)
+                except asyncio.TimeoutError:
+                    if not self._is_connection_alive():
+                        self._on_connection_lost(pypresence.PipeClosed())
+
+            delay = self.RECONNECT_MIN_DELAY
+            while not await self._connect():
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+            await self._resend()
+
+    async def _resend(self):
         try:
-            self._presence.clear()
+            if self._desired is None:
+                await self.clear()
+            elif self._desired is not _NOTHING:
+                await self.set_presence(**self._desired)
+        except pypresence.PyPresenceException:
+            pass  # the next update will try again
+
+    async def _send(self, method, **kwargs):
+        """Returns whether it was written to Discord, it's sent after reconnecting otherwise."""
+        async with self._send_lock:
+            if not self._is_connected:
+                return False
+
+            try:
+                await getattr(self._presence, method)(**kwargs)
+            except self.CONNECTION_ERRORS as e:
+                self._on_connection_lost(e)
+                return False
+
+            return True
+
+    async def clear(self):
+        self._desired = None
+
+        try:
+            return await self._send('clear')
         except pypresence.ResponseTimeout:
             # clear can timeout when using arRPC
             # see: https://github.com/RiiConnect24/RiiTag-RPC/issues/29
-            pass
+            return True
+
+    @timed('rpc_set_presence', 'Time spent sending a presence to Discord')
+    async def set_presence(self, **options):
+        self._desired = options
+
+        return await self._send('update', **options)
+
+
+class TokenBucket:
+    def __init__(self, capacity: int, period: float):
+        """Allows `capacity` actions per `period` seconds, refilling continuously."""
+        self.capacity = capacity
+        self.rate = capacity / period
+
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self):
+        self._refill()
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+    def time_until_available(self):
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+
+class PresenceDispatcher:
+    # Discord allows 5 SET_ACTIVITY calls per 20 seconds
+    RATE_LIMIT = 5
+    RATE_PERIOD = 20
+
+    RETRY_DELAY = 5
+
+    def __init__(self, rpc_handler: RPCHandler):
+        """Sends presence updates to Discord without running into its rate limit.
+
+        Updates identical to what Discord already shows are dropped. When the rate
+        limit is hit, updates are queued, and newer ones replace queued ones, so
+        only the most recent state is sent once the limit allows it.
+        """
+        self._rpc_handler = rpc_handler
+        self._bucket = TokenBucket(self.RATE_LIMIT, self.RATE_PERIOD)
+
+        self._last_sent = _NOTHING
+        self._pending = _NOTHING
+        self._flush_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()  # _last_sent is only known after sending, one dispatch at a time
+
+        self.sent_count = 0
+        self.deferred_count = 0  # not connected, the RPC handler sends it after reconnecting
+        self.dropped_count = 0
+        self.merged_count = 0
+
+    @property
+    def stats(self):
+        return {
+            'sent': self.sent_count,
+            'deferred': self.deferred_count,
+            'dropped': self.dropped_count,
+            'merged': self.merged_count,
+            'pending': self._pending is not _NOTHING
+        }
+
+    async def set_presence(self, **options):
+        await self._dispatch(options)
+
+    async def clear(self):
+        await self._dispatch(None)
+
+    async def _dispatch(self, state):
+        async with self._lock:
+            if self._pending is not _NOTHING:  # already waiting on the rate limit, replace what's queued
+                self.merged_count += 1
+                self._pending = _NOTHING if state == self._last_sent else state
+                return
+
+            if state == self._last_sent:
+                self.dropped_count += 1
+                return
+
+            if self._bucket.try_take():
+                # errors are raised to the caller, which will retry
+                await self._send(state)
+                return
+
+            self._pending = state
+            self._schedule_flush(self._bucket.time_until_available())
+
+    async def _send(self, state):
+        if state is None:
+            is_sent = await self._rpc_handler.clear()
+        else:
+            is_sent = await self._rpc_handler.set_presence(**state)
+
+        if not is_sent:
+            self.deferred_count += 1
+            return
+
+        self._last_sent = state
+        self.sent_count += 1
+
+    def _schedule_flush(self, delay):
+        if self._flush_task and not self._flush_task.done():
+            return
+
+        self._flush_task = asyncio.get_running_loop().create_task(self._flush(delay))
+
+    async def _flush(self, delay):
+        while self._pending is not _NOTHING:
+            await asyncio.sleep(delay)
+
+            async with self._lock:
+                if self._pending is _NOTHING:  # merged back into what's already shown
+                    return
+
+                if not self._bucket.try_take():
+                    delay = self._bucket.time_until_available()
+                    continue
 
-    def set_presence(self, **options):
-        self._presence.update(**options)
+                state, self._pending = self._pending, _NOTHING
+                try:
+                    await self._send(state)
+                except pypresence.PyPresenceException:
+                    self._pending = state  # nothing newer can have come in while we held the lock
+                    delay = self.RETRY_DELAY
+                else:
+                    delay = 0
@@ -0,0 +1,112 @@
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+DEFAULT_POOL_SIZE = 10
+
+# cover probes race many candidates with a short timeout, retrying a slow one only holds up the result
+NO_RETRY_PREFIXES = ('https://art.gametdb.com/',)
+
+
+_totals = {'requests': 0, 'connections': 0}
+_totals_lock = threading.Lock()
+
+
+class RiitagSession(requests.Session):
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, pool_size=DEFAULT_POOL_SIZE):
+        """HTTP session shared by everything that talks to the network.
+
+        Connections are kept alive and pooled per host, so repeated requests
+        don't need a new TCP and TLS handshake.
+
+        :param timeout: default timeout for requests, in seconds.
+        :param retries: how often idempotent requests are retried on connection errors or 5xx responses.
+        :param pool_size: the maximum number of connections kept per host.
+        """
+        super().__init__()
+
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            raise_on_status=False  # hand the last response back, callers check the status
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        no_retry_adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        for prefix in NO_RETRY_PREFIXES:
+            self.mount(prefix, no_retry_adapter)
+
+        self._seen_pools = weakref.WeakKeyDictionary()  # pool -> (requests, connections) already counted
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            self._count_usage()
+
+    def _count_usage(self):
+        # pools come and go (LRU eviction, configure()), so add what's new to the running totals
+        with _totals_lock:
+            for adapter in set(self.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if not pool:
+                        continue
+
+                    seen_requests, seen_connections = self._seen_pools.get(pool, (0, 0))
+                    _totals['requests'] += pool.num_requests - seen_requests
+                    _totals['connections'] += pool.num_connections - seen_connections
+                    self._seen_pools[pool] = (pool.num_requests, pool.num_connections)
+
+    @property
+    def stats(self):
+        """Request and connection counts since startup, across every session."""
+        with _totals_lock:
+            requests_made = _totals['requests']
+            connections = _totals['connections']
+
+        return {
+            'requests': requests_made,
+            'connections': connections,
+            'reused': max(requests_made - connections, 0)
+        }
+
+
+_session: RiitagSession | None = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> RiitagSession:
+    global _session
+
+    with _session_lock:
+        if not _session:
+            _session = RiitagSession()
+
+        return _session
+
+
+def configure(**kwargs):
+    """Replaces the shared session with one using different settings, see RiitagSession."""
+    global _session
+
+    with _session_lock:
+        old_session = _session
+        _session = RiitagSession(**kwargs)
+
+    if old_session:
+        old_session.close()
@@ -0,0 +1,48 @@
+import json
+import time
+
+from .util import atomic_write
+
+
+class StartupTimer:
+    def __init__(self):
+        """Keeps track of how long each startup step took, measured from app start."""
+        self._start = time.monotonic()
+
+        self.steps: dict[str, tuple[float, float]] = {}  # name -> (started, finished)
+        self.marks: dict[str, float] = {}
+
+    def _elapsed(self):
+        return time.monotonic() - self._start
+
+    async def measure(self, name, awaitable):
+        """Awaits `awaitable`, recording when it started and finished."""
+        started = self._elapsed()
+        try:
+            return await awaitable
+        finally:
+            self.steps[name] = (started, self._elapsed())
+
+    def mark(self, name):
+        """Records a milestone, only the first time it is reached."""
+        if name not in self.marks:
+            self.marks[name] = self._elapsed()
+
+    def to_dict(self):
+        return {
+            'steps': {
+                name: {'started': round(started, 3), 'duration': round(finished - started, 3)}
+                for name, (started, finished) in self.steps.items()
+            },
+            'marks': {name: round(at, 3) for name, at in self.marks.items()}
+        }
+
+    def save(self, fn):
+        atomic_write(fn, json.dumps(self.to_dict(), indent=4))
+
+    def __str__(self):
+        lines = [f'{name}: {finished - started:.2f}s (at {started:.2f}s)'
+                 for name, (started, finished) in self.steps.items()]
+        lines += [f'{name}: {at:.2f}s' for name, at in self.marks.items()]
+
+        return '\n'.join(lines)
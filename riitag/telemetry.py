@@ -0,0 +1,148 @@
+"""Error reporting through Sentry.
+
+sentry_sdk is slow to import, so it is only loaded once the first frame has been drawn. Tags and
+user info set before that are kept until then.
+
+Events go to one of these sinks:
+ * sentry - sent to the configured DSN
+ * file - appended to a local file as JSON lines, nothing leaves the machine
+ * none - sentry_sdk isn't even loaded
+"""
+import json
+import logging
+import os
+import threading
+
+SINKS = ('sentry', 'file', 'none')
+SINK_ENV = 'RIITAG_TELEMETRY'  # overrides the configured sink, e.g. for tests
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_initialized = False
+_active = False
+
+_user: dict | None = None
+_tags: dict = {}
+
+
+def get_sink(config: dict, preferred=None):
+    """Picks the sink to use. The environment wins over the preferences, which win over config.json.
+
+    :param config: the telemetry section of config.json
+    :param preferred: the sink from the user's preferences, if any
+    """
+    if not config.get('enabled', True):
+        sink = 'none'
+    else:
+        sink = config.get('sink', 'sentry')
+    if sink not in SINKS:
+        logger.warning('Unknown telemetry sink %r in config.json, disabling telemetry', sink)
+        sink = 'none'
+
+    for source, override in (('preferences', preferred), (SINK_ENV, os.getenv(SINK_ENV))):
+        if not override:
+            continue
+
+        if override in SINKS:
+            sink = override
+        else:
+            logger.warning('Unknown telemetry sink %r in %s, using %r', override, source, sink)
+
+    return sink
+
+
+def _make_file_transport(fn):
+    from sentry_sdk.transport import Transport
+
+    class FileTransport(Transport):
+        def __init__(self):
+            super().__init__()
+
+            self._file_lock = threading.Lock()
+
+        def _write(self, kind, payload):
+            line = json.dumps({'type': kind, 'payload': payload}, default=str)
+            with self._file_lock, open(fn, 'a', encoding='utf-8') as file:
+                file.write(line + '\n')
+
+        def capture_event(self, event):
+            self._write('event', event)
+
+        def capture_envelope(self, envelope):
+            for item in envelope.items:
+                if (payload := item.payload.json) is not None:
+                    self._write(item.type, payload)
+
+    return FileTransport()
+
+
+def init(sink='sentry', dsn=None, file=None, **options):
+    """Imports and initializes sentry_sdk. Blocks for a while, so preferably run in a thread.
+
+    :param sink: one of SINKS
+    :param file: where the file sink writes to
+    :param options: passed on to sentry_sdk.init, e.g. traces_sample_rate
+    """
+    global _initialized, _active
+
+    if sink == 'none':
+        with _lock:
+            _initialized = True
+        return
+
+    import sentry_sdk
+
+    with _lock:
+        if _initialized:
+            return
+
+        if sink == 'file':
+            sentry_sdk.init(transport=_make_file_transport(file), **options)
+        else:
+            sentry_sdk.init(dsn, **options)
+
+        with sentry_sdk.configure_scope() as scope:
+            if _user is not None:
+                # noinspection PyDunderSlots,PyUnresolvedReferences
+                scope.user = _user
+            for key, value in _tags.items():
+                scope.set_tag(key, value)
+
+        _initialized = True
+        _active = True
+
+
+def is_initialized():
+    return _initialized
+
+
+def set_user(user: dict):
+    global _user
+
+    with _lock:
+        _user = user
+        if _active:
+            import sentry_sdk
+
+            with sentry_sdk.configure_scope() as scope:
+                # noinspection PyDunderSlots,PyUnresolvedReferences
+                scope.user = user
+
+
+def set_tag(key, value):
+    with _lock:
+        _tags[key] = value
+        if _active:
+            import sentry_sdk
+
+            with sentry_sdk.configure_scope() as scope:
+                scope.set_tag(key, value)
+
+
+def capture_exception(exception):
+    """Reports an exception, only needed for ones the excepthook integration doesn't see."""
+    if _active:
+        import sentry_sdk
+
+        sentry_sdk.capture_exception(exception)
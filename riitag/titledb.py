@@ -0,0 +1,177 @@
+import json
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+from .util import atomic_write
+
+SNAPSHOT_MAGIC = b'RTDB'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<HI')  # version, length of the JSON header
+
+
+class _FixedWidthKeys:
+    # sequence view of a bytes object holding fixed width records, so bisect can search it
+    def __init__(self, data: bytes, width: int):
+        self._data = data
+        self._width = width
+
+    def __len__(self):
+        return len(self._data) // self._width
+
+    def __getitem__(self, index):
+        start = index * self._width
+        return self._data[start:start + self._width]
+
+
+class TitleIndex:
+    ID_SIZE = 6  # game IDs are at most 6 characters, e.g. RMCP01
+
+    def __init__(self, ids: bytes = b'', offsets: array = None, names: bytes = b'', overflow: dict = None):
+        """Compact, read-only game ID -> name index for one console.
+
+        :param ids: sorted game IDs, uppercased and NUL padded to ID_SIZE bytes each.
+        :param offsets: offsets into `names`, name `i` is `names[offsets[i]:offsets[i + 1]]`.
+        :param names: all names, UTF-8 encoded and concatenated.
+        :param overflow: game IDs that don't fit in `ids`, they are kept in a regular dict.
+        """
+        self._ids = ids
+        self._offsets = offsets if offsets is not None else array('I', [0])
+        self._names = names
+        self._overflow = overflow or {}
+
+        self._keys = _FixedWidthKeys(ids, self.ID_SIZE)
+
+    @classmethod
+    def build(cls, titles: dict[str, str]):
+        packed = {}
+        overflow = {}
+        for game_id, name in titles.items():
+            key = cls._pack(game_id)
+            if key is None:
+                overflow[game_id.upper()] = name
+            else:
+                packed[key] = name
+
+        ids = bytearray()
+        offsets = array('I', [0])
+        names = bytearray()
+        for key in sorted(packed):
+            ids += key
+            names += packed[key].encode('utf-8')
+            offsets.append(len(names))
+
+        return cls(bytes(ids), offsets, bytes(names), overflow)
+
+    @classmethod
+    def _pack(cls, game_id: str):
+        try:
+            key = game_id.upper().encode('ascii')
+        except UnicodeEncodeError:
+            return None
+
+        if len(key) > cls.ID_SIZE or b'\0' in key:
+            return None
+
+        return key.ljust(cls.ID_SIZE, b'\0')
+
+    def __len__(self):
+        return len(self._keys) + len(self._overflow)
+
+    def get(self, game_id: str, default=None):
+        key = self._pack(game_id)
+        if key is None:
+            return self._overflow.get(game_id.upper(), default)
+
+        index = bisect_left(self._keys, key)
+        if index == len(self._keys) or self._keys[index] != key:
+            return default
+
+        return self._names[self._offsets[index]:self._offsets[index + 1]].decode('utf-8')
+
+
+class TitleSnapshot:
+    def __init__(self, titles: dict[str, TitleIndex], fetched_at: float, validators: dict = None):
+        """On-disk copy of the GameTDB title database.
+
+        The file holds a small JSON header followed by the raw buffers of every
+        console's TitleIndex, so loading it doesn't need any parsing.
+
+        :param titles: console -> title index mapping.
+        :param fetched_at: when the titles were last downloaded or revalidated, as a UNIX timestamp.
+        :param validators: URL -> HTTP cache validators (etag, last_modified) of the downloaded files.
+        """
+        self.titles = titles
+        self.fetched_at = fetched_at
+        self.validators = validators or {}
+
+    @classmethod
+    def load(cls, fn):
+        """Loads a snapshot, returns None if it is missing, corrupt or outdated."""
+        try:
+            with open(fn, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+
+        if not data.startswith(SNAPSHOT_MAGIC):
+            return None
+
+        try:
+            pos = len(SNAPSHOT_MAGIC)
+            version, header_len = SNAPSHOT_HEADER.unpack_from(data, pos)
+            if version != SNAPSHOT_VERSION:
+                return None
+
+            pos += SNAPSHOT_HEADER.size
+            header = json.loads(data[pos:pos + header_len])
+            pos += header_len
+
+            if header['byteorder'] != sys.byteorder:  # written on another machine
+                return None
+
+            titles = {}
+            for console, info in header['consoles'].items():
+                ids = data[pos:pos + info['ids']]
+                pos += info['ids']
+
+                offsets = array('I')
+                offsets.frombytes(data[pos:pos + info['offsets']])
+                pos += info['offsets']
+
+                names = data[pos:pos + info['names']]
+                pos += info['names']
+
+                titles[console] = TitleIndex(ids, offsets, names, info['overflow'])
+        except (struct.error, ValueError, KeyError):
+            return None
+
+        return cls(titles, header.get('fetched_at', 0), header.get('validators'))
+
+    def save(self, fn):
+        consoles = {}
+        buffers = []
+        for console, index in self.titles.items():
+            offsets = index._offsets.tobytes()
+            consoles[console] = {
+                'ids': len(index._ids),
+                'offsets': len(offsets),
+                'names': len(index._names),
+                'overflow': index._overflow
+            }
+            buffers += [index._ids, offsets, index._names]
+
+        header = json.dumps({
+            'fetched_at': self.fetched_at,
+            'validators': self.validators,
+            'byteorder': sys.byteorder,
+            'consoles': consoles
+        }).encode('utf-8')
+
+        atomic_write(fn, b''.join([
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, len(header)),
+            header,
+            *buffers
+        ]))
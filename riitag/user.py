@@ -1,12 +1,25 @@
+import asyncio
 import datetime
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
+from .cache import PersistentCache
 from .exceptions import RiitagNotFoundError
+from .gameid import get_console, get_cover_regions
+from .instrumentation import registry, timed
+from .session import get_session
+from .titledb import TitleIndex, TitleSnapshot
+from .util import get_cache
 
 RIITAG_ENDPOINT = 'http://tag.rc24.xyz/{}/json'
 HEADERS = {'User-Agent': 'RiiTag-RPC WatchThread v2'}
 
+riitag_unchanged_counter = registry.counter('riitag_fetch_unchanged_total', 'RiiTag fetches that found no changes')
+cover_cache_hit_counter = registry.counter('cover_cache_hits_total', 'Cover URLs served from the cache')
+
 
 class RiitagGame:
     def __init__(self, **kwargs):
@@ -47,56 +60,194 @@ class RiitagInfo:
 class RiitagTitleResolver:
     WII_TITLES_URL = 'https://www.gametdb.com/wiitdb.txt?LANG=EN'
     WIIU_TITLES_URL = 'https://www.gametdb.com/wiiutdb.txt?LANG=EN'
+    TITLE_URLS = {
+        'wii': WII_TITLES_URL,
+        'wiiu': WIIU_TITLES_URL
+    }
 
     UPDATE_EVERY = datetime.timedelta(days=1)
 
+    SNAPSHOT_FILE = 'titles_{console}.db'
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self):
-        self.game_ids: dict[(str, str), str] = {}
-        self._last_update = datetime.datetime(year=1, month=1, day=1)
+        # every console is loaded and updated on its own, the first time it is resolved
+        self.titles: dict[str, TitleIndex] = {}
+        self._last_update: dict[str, datetime.datetime] = {}
+        self._validators: dict[str, dict] = {}
+        self._loaded_consoles = set()
+
+        self._update_lock = threading.Lock()
+        self._update_threads: dict[str, threading.Thread] = {}
+        self._update_listeners = []
+
+        self._cover_cache = None
+
+    @property
+    def cover_cache(self):
+        # created lazily, this is instantiated at import time
+        if not self._cover_cache:
+            self._cover_cache = PersistentCache(get_cache('covers.json'))
+
+        return self._cover_cache
+
+    def _load_snapshot(self, console: str):
+        self._loaded_consoles.add(console)
+
+        snapshot = TitleSnapshot.load(get_cache(self.SNAPSHOT_FILE.format(console=console)))
+        if not snapshot or console not in snapshot.titles:
+            return False
+
+        with self._update_lock:  # consoles load and update on their own threads
+            self.titles = {**self.titles, console: snapshot.titles[console]}
+            self._validators = {**self._validators, **snapshot.validators}
+            self._last_update[console] = datetime.datetime.fromtimestamp(snapshot.fetched_at)
+
+        return True
+
+    def _save_snapshot(self, console: str):
+        url = self.TITLE_URLS[console]
+        with self._update_lock:
+            index = self.titles.get(console)
+            url_validators = self._validators.get(url)
+        if index is None:
+            return
+
+        snapshot = TitleSnapshot(
+            {console: index},
+            self._last_update[console].timestamp(),
+            {url: url_validators} if url_validators else {}
+        )
+        try:
+            snapshot.save(get_cache(self.SNAPSHOT_FILE.format(console=console)))
+        except OSError:
+            pass  # we'll just download it again next time
+
+    def add_update_listener(self, callback):
+        """Registers a callback that is called (from a worker thread) when new titles are available."""
+        self._update_listeners.append(callback)
+
+    def remove_update_listener(self, callback):
+        if callback in self._update_listeners:
+            self._update_listeners.remove(callback)
+
+    def load(self, console: str):
+        """Loads the console's titles from disk, if that hasn't happened yet. Never touches the network."""
+        console = console.lower()
+        if console in self.TITLE_URLS and console not in self._loaded_consoles:
+            self._load_snapshot(console)
+
+    def update_maybe(self, console: str):
+        """Starts a background update if the console's titles are outdated. Never blocks on the network."""
+        console = console.lower()
+        if console not in self.TITLE_URLS:
+            return False
+
+        self.load(console)
 
-    def update_maybe(self):
         now = datetime.datetime.now()
-        if (now - self._last_update) >= self.UPDATE_EVERY:
-            self.update()
-            return True
-        return False
+        last_update = self._last_update.get(console)
+        if last_update and (now - last_update) < self.UPDATE_EVERY:
+            return False
+
+        with self._update_lock:
+            thread = self._update_threads.get(console)
+            if thread and thread.is_alive():
+                return False
+
+            thread = threading.Thread(target=self._background_update, args=(console,), daemon=True)
+            self._update_threads[console] = thread
+            thread.start()
+
+        return True
+
+    def _background_update(self, console: str):
+        if self.update(console):
+            for callback in list(self._update_listeners):
+                callback()
+
+    @timed('titledb_update', 'Time spent downloading and indexing a title database')
+    def update(self, console: str):
+        """Downloads the title database of a console, returns whether any titles changed."""
+        url = self.TITLE_URLS[console]
+
+        validators = {url: self._validators[url]} if url in self._validators else {}
+        db = self._get_data(url, validators)
+
+        self._last_update[console] = datetime.datetime.now()
+        if not db:
+            if db is None:  # not modified, keep what we have
+                self._save_snapshot(console)
+
+            return False
 
-    def update(self):
-        wii_db = self._get_data(self.WII_TITLES_URL)
-        for game_id, name in wii_db.items():
-            self.game_ids[('wii', game_id)] = name
+        index = TitleIndex.build(db)
 
-        wiiu_db = self._get_data(self.WIIU_TITLES_URL)
-        for game_id, name in wiiu_db.items():
-            self.game_ids[('wiiu', game_id)] = name
+        # swap in new mappings, readers never see a partial update. only touch this console's entries,
+        # the other console may be updating at the same time
+        with self._update_lock:
+            self.titles = {**self.titles, console: index}
+            self._validators = {**self._validators, url: validators[url]}
 
-        self._last_update = datetime.datetime.now()
+        self._save_snapshot(console)
+
+        return True
 
     def get_game_name(self, console: str, game_id: str):
-        return self.game_ids.get((console.lower(), game_id.upper()), 'Unknown')
+        index = self.titles.get(console.lower())
+        if not index:
+            return 'Unknown'
+
+        return index.get(game_id, 'Unknown')
 
     def resolve(self, console: str, game_id: str):
-        self.update_maybe()
+        console = console or get_console(game_id)  # older tags don't say which console the game was on
+        self.update_maybe(console)
 
         return RiitagTitle(self, console, game_id)
 
-    def _get_data(self, url: str):
-        try:
-            r = requests.get(url, headers=HEADERS)
-            r.raise_for_status()
+    def _get_data(self, url: str, validators: dict):
+        """Downloads and parses a title database, updating the validators in `validators`.
 
-            return self._parse_db(r.text)
+        Returns None if it didn't change since the last download, or an empty dict on errors.
+        """
+        headers = dict(HEADERS)
+        url_validators = validators.get(url, {})
+        if etag := url_validators.get('etag'):
+            headers['If-None-Match'] = etag
+        if last_modified := url_validators.get('last_modified'):
+            headers['If-Modified-Since'] = last_modified
+
+        try:
+            with get_session().get(url, headers=headers, stream=True) as r:
+                if r.status_code == 304:
+                    return None
+                r.raise_for_status()
+
+                r.encoding = 'utf-8-sig'  # GameTDB doesn't send a charset
+                lines = r.iter_lines(chunk_size=self.CHUNK_SIZE, decode_unicode=True)
+                db = self._parse_db(lines)
         except requests.RequestException:
             return {}
 
-    def _parse_db(self, db: str):
+        if db:
+            validators[url] = {
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified')
+            }
+
+        return db
+
+    def _parse_db(self, lines):
         res = {}
-        for line in db.splitlines():
-            game_id, title = line.split(' = ')
-            if game_id == 'TITLES':
-                continue
+        for line in lines:
+            game_id, sep, title = line.partition(' = ')
+            game_id = game_id.strip()
+            if not sep or not game_id or game_id == 'TITLES':
+                continue  # header or malformed line
+
+            res[game_id] = title.strip()
 
-            res[game_id] = title
         return res
 
 
@@ -114,7 +265,7 @@ class RiitagTitle:
         'wii': 'Wii',
         'wiiu': 'Wii U',
     }
-    REGION = (
+    REGION = (  # used when the region can't be derived from the game ID
         'EN',
         'US',
         'JA'
@@ -123,6 +274,13 @@ class RiitagTitle:
         'png',
         'jpg'
     )
+
+    COVER_FOUND_TTL = 30 * 24 * 60 * 60
+    COVER_NOTFOUND_TTL = 24 * 60 * 60
+
+    PROBE_WORKERS = 10
+    PROBE_TIMEOUT = 5
+
     def __init__(self, resolver: RiitagTitleResolver, console: str, game_id: str):
         self._resolver = resolver
 
@@ -138,29 +296,70 @@ class RiitagTitle:
         console = self.console.lower()
         return self.CONSOLE_NAMES.get(console, console)
 
+    @timed('cover_lookup', 'Time spent finding the cover URL of a game')
     def get_cover_url(self):
+        cache = self._resolver.cover_cache
+        cache_key = f'{self.console.lower()}/{self.game_id}'
+        if url := cache.get(cache_key):
+            cover_cache_hit_counter.inc()
+            return url
+
+        url = self._probe_cover_url()
+        if url is None:  # network trouble, don't remember this
+            return self.NOTFOUND_URL
+
+        ttl = self.COVER_NOTFOUND_TTL if url == self.NOTFOUND_URL else self.COVER_FOUND_TTL
+        cache.set(cache_key, url, ttl)
+
+        return url
+
+    def _get_cover_candidates(self):
+        """All possible cover URLs, most preferred first."""
         for img_type in self.IMG_TYPES:
-            for region in self.REGION:
+            for region in get_cover_regions(self.game_id, default=self.REGION):
                 for file_type in self.FILE_TYPES:
-                    try:
-                        url = self.COVER_URL.format(
-                            console=self.console.lower(),
-                            img_type=img_type,
-                            game_id=self.game_id,
-                            file_type=file_type,
-                            region=region
-                        )
-                        r = requests.head(url)
-                    except requests.RequestException:
-                        continue
-
-                    if r.status_code == 200:
+                    yield self.COVER_URL.format(
+                        console=self.console.lower(),
+                        img_type=img_type,
+                        game_id=self.game_id,
+                        file_type=file_type,
+                        region=region
+                    )
+
+    @classmethod
+    def _probe(cls, url, found):
+        if found.is_set():  # a better candidate already won
+            return False
+
+        r = get_session().head(url, timeout=cls.PROBE_TIMEOUT)
+        return r.status_code == 200
+
+    def _probe_cover_url(self):
+        candidates = list(self._get_cover_candidates())
+
+        found = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.PROBE_WORKERS)
+        futures = [executor.submit(self._probe, url, found) for url in candidates]
+
+        had_error = False
+        try:
+            # all probes run in parallel, but we wait on them in order of preference
+            for url, future in zip(candidates, futures):
+                try:
+                    if future.result():
+                        found.set()
                         return url
+                except requests.RequestException:
+                    had_error = True
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        return self.NOTFOUND_URL
+        return None if had_error else self.NOTFOUND_URL
 
 
 class User:
+    PROFILE_FIELDS = ('id', 'username', 'discriminator', 'avatar', 'locale')
+
     def __init__(self, **kwargs):
         """Represents a RiiTag / Discord user."""
         self.id = kwargs.get('id')
@@ -170,23 +369,57 @@ class User:
         self.locale = kwargs.get('locale')
 
         self.riitag = None
+        self._riitag_etag = None
+        self._riitag_hash = None
+
+    def to_dict(self):
+        """The Discord profile, in the same format as /users/@me."""
+        return {field: getattr(self, field) for field in self.PROFILE_FIELDS}
+
+    def update_profile(self, other: 'User'):
+        """Takes over the Discord profile of `other`, keeping the RiiTag state."""
+        for field in self.PROFILE_FIELDS:
+            setattr(self, field, getattr(other, field))
+
+    async def fetch_riitag_async(self):
+        """Like fetch_riitag, without blocking the event loop."""
+        return await asyncio.to_thread(self.fetch_riitag)
 
+    @timed('riitag_fetch', 'Time spent fetching the RiiTag')
     def fetch_riitag(self):
+        """Fetches the user's RiiTag.
+
+        If it didn't change since the last fetch, the previous RiitagInfo is returned as-is.
+        """
         url = RIITAG_ENDPOINT.format(self.id)
 
+        headers = dict(HEADERS)
+        if self.riitag and self._riitag_etag:
+            headers['If-None-Match'] = self._riitag_etag
+
         try:
-            r = requests.get(url, headers=HEADERS)
+            r = get_session().get(url, headers=headers)
+            if r.status_code == 304 and self.riitag:
+                riitag_unchanged_counter.inc()
+                return self.riitag
             r.raise_for_status()
         except requests.exceptions.RequestException:
             self.riitag = None
 
             return
 
+        content_hash = hashlib.sha1(r.content).digest()
+        if self.riitag and content_hash == self._riitag_hash:
+            riitag_unchanged_counter.inc()
+            return self.riitag
+
         data = r.json()
         if error := data.get('error'):
             raise RiitagNotFoundError(error)
 
         riitag = RiitagInfo(**data)
         self.riitag = riitag
+        self._riitag_etag = r.headers.get('ETag')
+        self._riitag_hash = content_hash
 
         return riitag
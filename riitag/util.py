@@ -24,3 +24,13 @@ def get_cache_dir():
 
 def get_cache(filename):
     return os.path.join(get_cache_dir(), filename)
+
+
+def atomic_write(fn, data: str | bytes):
+    """Write a file by replacing it, so readers never see a half-written file."""
+    tmp_fn = f'{fn}.tmp'
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(tmp_fn, mode) as file:
+        file.write(data)
+
+    os.replace(tmp_fn, fn)
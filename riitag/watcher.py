@@ -1,6 +1,7 @@
-import time
+import asyncio
+import copy
+import random
 from datetime import datetime, timedelta
-from threading import Thread
 from typing import TYPE_CHECKING
 
 from prompt_toolkit.application import get_app
@@ -14,21 +15,83 @@ if TYPE_CHECKING:
     from start import RiiTagApplication
 
 
-class RiitagWatcher(Thread):
+class PollScheduler:
+    ACTIVE_BACKOFF = 1.5
+    IDLE_BACKOFF = 2
+
+    ERROR_DELAY = 5
+
+    def __init__(self, preferences: Preferences):
+        """Decides how long to wait between RiiTag checks.
+
+        Checks are quick right after the game changed, and slow down while nothing
+        happens: up to the check interval while playing, and up to the maximum
+        check interval while idle. Errors back off exponentially, with jitter.
+        """
+        self.preferences = preferences
+
+        self._interval = 0
+        self._error_count = 0
+
+    @property
+    def min_interval(self):
+        return self.preferences.min_check_interval
+
+    @property
+    def max_interval(self):
+        return max(self.preferences.max_check_interval, self.min_interval)
+
+    def on_change(self):
+        self._error_count = 0
+        self._interval = self.min_interval
+
+        return self._interval
+
+    def on_unchanged(self, idle):
+        self._error_count = 0
+
+        if idle:
+            backoff, limit = self.IDLE_BACKOFF, self.max_interval
+        else:
+            backoff, limit = self.ACTIVE_BACKOFF, min(self.preferences.check_interval, self.max_interval)
+        limit = max(limit, self.min_interval)
+
+        self._interval = min(max(self._interval * backoff, self.min_interval), limit)
+
+        return self._interval
+
+    def on_error(self):
+        self._error_count += 1
+
+        delay = min(self.ERROR_DELAY * 2 ** (self._error_count - 1), self.max_interval)
+        return random.uniform(delay / 2, delay)
+
+
+class RiitagWatcher:
     def __init__(self, preferences: Preferences, user: User,
-                 update_callback, message_callback, *args, **kwargs):
-        super().__init__(*args, **kwargs, daemon=True)
+                 update_callback, message_callback, riitag: RiitagInfo | None = None):
+        """Watches a user's RiiTag for changes, as a task on the application's event loop.
 
+        :param update_callback: coroutine function that is awaited with the new RiitagInfo.
+        :param riitag: an already fetched RiiTag to start with, saves a request on the first run.
+        """
         self.preferences = preferences
         self._user = user
         self._update_callback = update_callback
         self._message_callback = message_callback
 
         self._run = True
-        self._last_check = datetime(year=2000, month=1, day=1)  # force check on first run
+        self._force_update = False
+        self._wakeup = asyncio.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+        self._next_check = datetime(year=2000, month=1, day=1)  # force check on first run
         self._no_riitag_warning_shown = False
 
+        self._scheduler = PollScheduler(preferences)
+        self._initial_riitag = riitag
         self._last_riitag: RiitagInfo = RiitagInfo()
+        self._last_fetched: RiitagInfo | None = None
 
     @property
     def interval(self):
@@ -41,16 +104,57 @@ class RiitagWatcher(Thread):
     def start(self):
         self._run = True
 
-        super().start()
+        app = get_app()
+        self._loop = app.loop
+        self._task = app.create_background_task(self.run())
 
     def stop(self):
         self._run = False
+        self.wake()
+
+    def wake(self):
+        """Interrupts the current wait, so the watcher re-evaluates its state right away.
+
+        Safe to call from other threads.
+        """
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def request_update(self):
+        """Makes the watcher re-send the current RiiTag, e.g. after the game titles changed."""
+        self._force_update = True
+        self.wake()
+
+    def preferences_changed(self):
+        # the schedule was based on the old preferences, check again right away
+        self._next_check = datetime.utcnow()
+        self.wake()
+
+    async def _wait(self, seconds):
+        if seconds > 0:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), seconds)
+            except asyncio.TimeoutError:
+                pass
+        self._wakeup.clear()
 
-    def _get_riitag(self):
+    def _get_next_deadline(self):
+        deadline = self._next_check
+
+        if self._last_riitag and not self._last_riitag.outdated:
+            if last_play_time := self._last_riitag.last_played.time:
+                timeout_at = last_play_time + timedelta(minutes=self.presence_timeout)
+                deadline = min(deadline, timeout_at)
+
+        return deadline
+
+    async def _get_riitag(self):
         try:
-            riitag = self._user.fetch_riitag()
+            riitag = await self._user.fetch_riitag_async()
         except RiitagNotFoundError:
             if not self._no_riitag_warning_shown:
+                self._no_riitag_warning_shown = True
+
                 app: RiiTagApplication = get_app()
                 app.show_message(
                     'RiiTag not found',
@@ -61,36 +165,57 @@ class RiitagWatcher(Thread):
 
         return riitag
 
-    def run(self):
-        self._last_riitag = self._get_riitag()
+    async def run(self):
+        self._last_riitag = self._initial_riitag or await self._get_riitag()
+        self._last_fetched = self._last_riitag
+        self._force_update = True  # unchanged tags are reused, make sure the first one gets sent
+        if self._last_riitag is not None:
+            # we just fetched it, no need to check again right away
+            self._next_check = datetime.utcnow() + timedelta(seconds=self._scheduler.on_change())
 
         while self._run:
             new_riitag = self._last_riitag
+            is_changed = None
 
             now = datetime.utcnow()
-            if now - self._last_check >= timedelta(seconds=self.interval):
+            if now >= self._next_check:
                 # time for a new check!
-                self._last_check = now
-
-                new_riitag = self._get_riitag()
+                new_riitag = await self._get_riitag()
                 if new_riitag is None:
                     # some error while fetching, probably server issue
-                    time.sleep(5)
+                    self._next_check = now + timedelta(seconds=self._scheduler.on_error())
                     continue
 
+                # fetch_riitag hands back the same object if nothing changed,
+                # a missing RiiTag comes back as a new empty one every time
+                is_changed = new_riitag is not self._last_fetched and bool(new_riitag or self._last_fetched)
+                self._last_fetched = new_riitag
+
             if self._last_riitag:
                 last_play_time = self._last_riitag.last_played.time
                 if not last_play_time or now - last_play_time >= timedelta(minutes=self.presence_timeout):
+                    # unchanged tags are reused by fetch_riitag, flag a copy instead
+                    new_riitag = copy.copy(new_riitag)
                     new_riitag.outdated = True
 
-            if new_riitag != self._last_riitag:
+            if is_changed is not None:
+                if is_changed:
+                    delay = self._scheduler.on_change()
+                else:
+                    delay = self._scheduler.on_unchanged(idle=not new_riitag or new_riitag.outdated)
+                self._next_check = now + timedelta(seconds=delay)
+
+            if new_riitag != self._last_riitag or self._force_update:
+                self._force_update = False
                 try:
-                    self._update_callback(new_riitag)
+                    await self._update_callback(new_riitag)
                 except PyPresenceException:
                     # failed to set presence. We will retry later.
-                    time.sleep(5)
+                    self._force_update = True
+                    await self._wait(5)
                     continue
 
                 self._last_riitag = new_riitag
 
-            time.sleep(1)
+            # nothing to do until the next check or until the presence times out
+            await self._wait((self._get_next_deadline() - datetime.utcnow()).total_seconds())
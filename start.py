@@ -1,14 +1,16 @@
+import asyncio
+import functools
 import json
 import os
 import sys
 import threading
 import traceback
 import uuid
+from typing import TYPE_CHECKING
 
-import nest_asyncio
-import sentry_sdk
 from prompt_toolkit.application import Application, DummyApplication, get_app
 from prompt_toolkit.formatted_text import HTML
+from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.layout import Layout, DynamicContainer, FloatContainer, \
     Float, FormattedTextControl
 from prompt_toolkit.layout.containers import HSplit, VSplit, Window, WindowAlign
@@ -16,11 +18,14 @@ from prompt_toolkit.shortcuts import set_title
 from prompt_toolkit.widgets import Button
 from prompt_toolkit.widgets import Frame
 
-import menus
-from riitag import oauth2, user, watcher, presence, preferences
+# menus and the network modules pull in requests and pypresence, which are slow to import.
+# they're imported once the first frame is drawn, see RiiTagApplication._load
+from riitag import preferences, startup, telemetry, instrumentation
 from riitag.util import get_cache
 
-nest_asyncio.apply()
+if TYPE_CHECKING:
+    import menus
+    from riitag import oauth2, user, watcher, presence
 
 
 def on_error(exc_type, exc_value, exc_traceback):
@@ -50,6 +55,13 @@ def on_error(exc_type, exc_value, exc_traceback):
     )
     print()
 
+    if not telemetry.is_initialized():  # died before the first frame, report it anyway
+        try:
+            init_telemetry(preferences.Preferences.load(get_cache('prefs.json')))
+            telemetry.capture_exception(exc_value)
+        except Exception:
+            pass
+
     print('** Original exception was: **')
     traceback.print_exception(exc_value)
     print()
@@ -114,42 +126,143 @@ except FileNotFoundError:
     sys.exit(1)
 
 VERSION = CONFIG.get('version', '<unknown_version>')
-sentry_sdk.init(
-    "https://0206915cd7604929997a753583292296@o107347.ingest.sentry.io/5450405",
-    traces_sample_rate=1.0,
-    release=f'riitag-rpc@{VERSION}'
-)
-with sentry_sdk.configure_scope() as scope:
-    # noinspection PyDunderSlots,PyUnresolvedReferences
-    scope.user = {'id': get_user_id()}
-    scope.set_tag('bundled', is_bundled())
+telemetry.set_user({'id': get_user_id()})
+telemetry.set_tag('bundled', is_bundled())
+
+
+@functools.cache
+def get_banner():
+    with open(resource_path('banner.txt'), 'r') as banner:
+        return banner.read()
+
+
+def import_app_modules():
+    import menus  # noqa: F401, imports everything else too
+
+
+def init_telemetry(prefs: preferences.Preferences):
+    config = CONFIG.get('telemetry', {})
+    telemetry.init(
+        telemetry.get_sink(config, prefs.telemetry_sink),
+        dsn=config.get('dsn'),
+        file=get_cache('telemetry.jsonl'),
+        traces_sample_rate=config.get('traces_sample_rate', 0.0),
+        release=f'riitag-rpc@{VERSION}'
+    )
+
+
+class LoadingScreen:
+    name = 'Loading'
+    is_framed = False
+
+    def __init__(self, application: 'RiiTagApplication'):
+        """Looks like the splash screen, shown while the menus are being imported."""
+        self.app = application
+
+    def get_layout(self):
+        return self.app.get_splash_layout('Loading...')
+
+    def get_all_kb(self):
+        kb = KeyBindings()
+
+        @kb.add('c-c')
+        @kb.add('q')
+        def exit_app(_):
+            self.app.exit()
+
+        return kb
+
+    def on_start(self):
+        pass
+
+    def on_exit(self):
+        pass
 
 
 class RiiTagApplication(Application):
     def __init__(self, *args, **kwargs):
-        self._current_menu: menus.Menu | None = None
+        self._current_menu: menus.Menu | LoadingScreen = LoadingScreen(self)
         self._float_message_layout = None
 
         self.preferences = preferences.Preferences.load(get_cache('prefs.json'))
-        self.oauth_client = oauth2.OAuth2Client(CONFIG.get('oauth2'))
-        self.rpc_handler = presence.RPCHandler(
-            CONFIG.get('rpc', {}).get('client_id')
-        )
+        self.startup_timer = startup.StartupTimer()
+
+        # set up in _load
+        self.oauth_client: oauth2.OAuth2Client | None = None
+        self.rpc_handler: presence.RPCHandler | None = None
+        self.presence_dispatcher: presence.PresenceDispatcher | None = None
 
-        self.set_menu(menus.SplashScreen)
         set_title(self.version_string)
 
         super().__init__(*args, **kwargs,
                          layout=Layout(DynamicContainer(self._get_layout)),
                          full_screen=True)
 
+        # menus run their tasks on the event loop, so wait for it to start
+        self.pre_run_callables.append(self._set_exception_handler)
+        self.after_render += self._on_first_render
+
         self.token: oauth2.OAuth2Token | None = None
+        self.token_manager: oauth2.OAuth2TokenManager | None = None
         self.user: user.User | None = None
 
         self.riitag_watcher: watcher.RiitagWatcher | None = None
 
+    async def _load(self):
+        await self.startup_timer.measure('imports', asyncio.to_thread(import_app_modules))
+
+        import menus
+        from riitag import oauth2, presence, session
+
+        session.configure(**CONFIG.get('http', {}))
+        self.oauth_client = oauth2.OAuth2Client(CONFIG.get('oauth2'))
+        self.rpc_handler = presence.RPCHandler(
+            CONFIG.get('rpc', {}).get('client_id')
+        )
+        self.presence_dispatcher = presence.PresenceDispatcher(self.rpc_handler)
+        self._register_counters()
+
         self.oauth_client.start_server(CONFIG.get('port', 4000))
 
+        self.set_menu(menus.SplashScreen)
+
+    def _register_counters(self):
+        from riitag.session import get_session
+
+        dispatcher = self.presence_dispatcher
+        counters = (
+            ('presence_sent_total', 'Presence updates sent to Discord', lambda: dispatcher.stats['sent']),
+            ('presence_deferred_total', 'Presence updates held back until Discord is connected again',
+             lambda: dispatcher.stats['deferred']),
+            ('presence_dropped_total', 'Presence updates skipped as duplicates', lambda: dispatcher.stats['dropped']),
+            ('presence_merged_total', 'Presence updates replaced while rate limited',
+             lambda: dispatcher.stats['merged']),
+            ('http_requests_total', 'HTTP requests made', lambda: get_session().stats['requests']),
+            ('http_connections_total', 'HTTP connections created', lambda: get_session().stats['connections']),
+            ('http_connections_reused_total', 'HTTP requests that reused a connection',
+             lambda: get_session().stats['reused']),
+        )
+        for name, description, func in counters:
+            instrumentation.registry.counter_func(name, description, func)
+
+    def _on_first_render(self, _):
+        self.after_render -= self._on_first_render
+
+        self.create_background_task(self._load())
+        # sentry_sdk takes a while to import, don't hold up the startup steps either
+        self.create_background_task(asyncio.to_thread(init_telemetry, self.preferences))
+
+    def _set_exception_handler(self):
+        # report errors in background tasks like we do for threads
+        self.loop.set_exception_handler(self._handle_loop_exception)
+
+    # noinspection PyMethodMayBeStatic
+    def _handle_loop_exception(self, loop, context):
+        if exception := context.get('exception'):
+            sys.excepthook(type(exception), exception, exception.__traceback__)
+        else:
+            loop.default_exception_handler(context)
+
     def _get_layout(self):
         menu_layout = self._current_menu.get_layout()
         if self._current_menu.is_framed:
@@ -191,7 +304,18 @@ class RiiTagApplication(Application):
     def header_string(self):
         return f'RiiTag-RPC - {self._current_menu.name}'
 
+    def get_splash_layout(self, status):
+        return HSplit([
+            Window(FormattedTextControl(get_banner()), align=WindowAlign.CENTER),
+            Window(FormattedTextControl(
+                f'{self.version_string}\nCreated by Mike Almeloo\n\n\n{status}'),
+                align=WindowAlign.CENTER
+            )
+        ])
+
     def set_menu(self, menu):
+        import menus
+
         if not issubclass(menu, menus.Menu):
             raise ValueError('menu must be a subclass of menus.Menu')
 
@@ -199,9 +323,9 @@ class RiiTagApplication(Application):
             self._current_menu.on_exit()
 
         self._current_menu = menu(self)
-        if hasattr(self, '_is_running'):
+        if getattr(self, '_is_running', False):  # otherwise started once the application runs
             self.invalidate()
-        self._current_menu.on_start()
+            self._current_menu.on_start()
 
     def show_message(self, title, message, callback=None):
         cancel_button = Button('Cancel', handler=lambda: response_received(False))
@@ -233,7 +357,7 @@ class RiiTagApplication(Application):
 
 def main():
     application = RiiTagApplication()
-    application.run()
+    application.run(set_exception_handler=False)
 
 
 if __name__ == "__main__":
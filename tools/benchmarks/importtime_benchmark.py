@@ -0,0 +1,95 @@
+"""Measures how long RiiTag-RPC takes to import, using the output of `python -X importtime`.
+
+Usage: python tools/benchmarks/importtime_benchmark.py [--log importtime.log] [--top 15] [--max-ms 300] [module]
+
+Without --log, `module` (default: start) is imported in a fresh interpreter from the repository root.
+For the frozen build, capture the output of a build with the `('X importtime', None, 'OPTION')` run-time
+option in the spec file and pass it with --log.
+
+With --max-ms, the script exits with status 1 when the total import time exceeds it.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def run_importtime(module):
+    with tempfile.TemporaryDirectory() as home:
+        # keep the cache dir that start.py creates away from the real one
+        env = dict(os.environ, HOME=home, XDG_CACHE_HOME=home, LOCALAPPDATA=home)
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=ROOT, env=env, capture_output=True, text=True
+        )
+
+    if result.returncode != 0:
+        sys.exit(f'Importing {module} failed:\n{result.stderr}')
+
+    return result.stderr
+
+
+def parse_importtime(output):
+    """Returns a list of (module, self_us, cumulative_us, depth) tuples, in import order."""
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():  # header
+            continue
+
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+
+    return entries
+
+
+def group_by_package(entries):
+    """Sums the self time of every module per top-level package."""
+    packages = {}
+    for name, self_us, _, _ in entries:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('module', nargs='?', default='start')
+    parser.add_argument('--log', help='parse this -X importtime output instead of importing `module`')
+    parser.add_argument('--top', type=int, default=15, help='number of packages to list')
+    parser.add_argument('--max-ms', type=float, help='fail when the total import time exceeds this')
+    args = parser.parse_args()
+
+    if args.log:
+        output = Path(args.log).read_text(encoding='utf-8', errors='replace')
+    else:
+        output = run_importtime(args.module)
+
+    entries = parse_importtime(output)
+    if not entries:
+        sys.exit('No -X importtime output found.')
+
+    total_us = sum(self_us for _, self_us, _, _ in entries)
+    packages = sorted(group_by_package(entries).items(), key=lambda item: item[1], reverse=True)
+
+    print(f'{"package":<30} {"time (ms)":>10} {"share":>7}')
+    for package, self_us in packages[:args.top]:
+        print(f'{package:<30} {self_us / 1000:>10.1f} {self_us / total_us:>7.1%}')
+    print()
+    print(f'{len(entries)} modules, {total_us / 1000:.1f}ms in total')
+
+    if args.max_ms is not None and total_us / 1000 > args.max_ms:
+        print(f'Import time exceeds the limit of {args.max_ms:.1f}ms!')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Compares memory use and lookup speed of the title database structures.
+
+Usage: python tools/benchmarks/titledb_benchmark.py [wiitdb.txt] [wiiutdb.txt]
+
+Without arguments, a synthetic database of a similar size is used.
+"""
+import random
+import string
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+# make the riitag package importable when running from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from riitag.titledb import TitleIndex  # noqa: E402
+
+LOOKUPS = 100_000
+
+
+def synthetic_db(count):
+    rng = random.Random(1337)
+    db = {}
+    while len(db) < count:
+        game_id = ''.join(rng.choices(string.ascii_uppercase + string.digits, k=6))
+        db[game_id] = ' '.join(
+            ''.join(rng.choices(string.ascii_letters, k=rng.randint(3, 9)))
+            for _ in range(rng.randint(1, 5))
+        )
+    return db
+
+
+def read_db(fn):
+    db = {}
+    with open(fn, encoding='utf-8-sig') as file:
+        for line in file:
+            game_id, sep, title = line.partition(' = ')
+            if sep and game_id.strip() != 'TITLES':
+                db[game_id.strip()] = title.strip()
+    return db
+
+
+def measure(build):
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    if len(sys.argv) > 1:
+        dbs = {console: read_db(fn) for console, fn in zip(('wii', 'wiiu'), sys.argv[1:3])}
+    else:
+        dbs = {'wii': synthetic_db(9_000), 'wiiu': synthetic_db(3_000)}
+
+    # build the title strings outside of the measurements, so both sides get the same input
+    raw = {console: [(game_id, name) for game_id, name in db.items()] for console, db in dbs.items()}
+
+    def build_tuple_dict():
+        return {(console, game_id): name for console, items in raw.items() for game_id, name in items}
+
+    def build_index():
+        return {console: TitleIndex.build(dict(items)) for console, items in raw.items()}
+
+    tuple_dict, tuple_size = measure(build_tuple_dict)
+    index, index_size = measure(build_index)
+
+    total = sum(len(items) for items in raw.values())
+    print(f'Titles:              {total}')
+    print(f'tuple-keyed dict:    {tuple_size / 1024:8.1f} KiB')
+    print(f'per-console index:   {index_size / 1024:8.1f} KiB '
+          f'({100 - index_size / tuple_size * 100:.0f}% smaller)')
+
+    rng = random.Random(42)
+    keys = [(console, game_id.lower()) for console, items in raw.items() for game_id, _ in items]
+    sample = [rng.choice(keys) for _ in range(LOOKUPS)]
+
+    dict_time = timeit.timeit(
+        lambda: [tuple_dict.get((c.lower(), g.upper()), 'Unknown') for c, g in sample], number=1)
+    index_time = timeit.timeit(
+        lambda: [index[c.lower()].get(g, 'Unknown') for c, g in sample], number=1)
+
+    print(f'tuple-keyed lookup:  {dict_time / LOOKUPS * 1e6:8.2f} us')
+    print(f'index lookup:        {index_time / LOOKUPS * 1e6:8.2f} us')
+
+
+if __name__ == '__main__':
+    main()